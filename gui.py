@@ -7,27 +7,40 @@
 #
 
 from __future__ import print_function
+import bisect
+import ctypes
 import curses
+import errno
+import fcntl
+import functools
 import os
 import glob
+import hashlib
+import json
+import math
+import mmap
 import platform
+import random
 import time
 import re
 import shutil
+import socket
+import stat
+import struct
 import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4, UUID
 
-from hardware_inventory import disk_info
 import shell
 import sysUtil
-import minimum_reqs
 from consts import (PHOENIX_VERSION, IMAGES_DIR, factory_exchange_dir,
                     ValidationError, ARCH_PPC, DRIVER_PACKAGE_NAME, DRIVERS_DIR,
                     MAX_DISK_SERIAL, MAX_DEV, MAX_MODEL, MAX_TYPE, MAX_SZ)
 from gui_widgets import (BaseCheckBox, CursesControl, BaseTextViewBlock,
                          BaseElementHandler, Button, RadioButton, TextEditor,
                          FakeText)
-from factory_workflow import fatal_exc_handler
 from param_list import ParamList
 from log import (ERROR, set_log_fatal_callback, disable_ttyout_handler,
                  enable_ttyout_handler)
@@ -35,12 +48,6 @@ from gui_actions import (
     INSTALL_HYPERVISOR, CONFIGURE_HYPERVISOR, INSTALL_SVM, REPAIR_SVM,
     determine_actions, get_hypervisor_images_for_action,
     get_nos_images_for_action)
-from gui_review import get_review_content
-from images import (get_packaged_nos, get_packaged_hyp, get_nos_from_cvm,
-                    gui_message, HypervisorImages)
-from layout.layout_finder import get_layout
-from layout.layout_tools import get_possible_boot_devices_from_layout
-from shared_functions import validate_and_correct_network_addresses
 
 XC6320_BANNER = \
 """\033[1m\033[5m
@@ -73,6 +80,123 @@ The Node Serial is set to the system Service Tag.  Do *NOT* change this value.
 one_node_cluster = False
 network_setup = False
 
+# Seconds a single device may take to be probed before it is left out.
+DISK_PROBE_TIMEOUT = 10
+NETLINK_KOBJECT_UEVENT = 15
+VIRTUAL_BLOCK_PREFIXES = ('loop', 'ram', 'zram', 'sr', 'fd', 'nbd')
+# Written by generate_iso into the images dir.
+IMAGE_CATALOG_NAME = 'image_catalog.json'
+# getch timeout of pages waiting on background work, in milliseconds.
+IDLE_POLL_MS = 200
+PROBE_TIMELINE_PATH = '/tmp/hardware_probes.json'
+KEYMAP_DIRS = ['/usr/share/keymaps', '/usr/share/kbd/keymaps',
+               '/usr/lib/kbd/keymaps']
+KEYMAP_SUFFIXES = ('.map', '.map.gz')
+VCONSOLE_CONF = '/etc/vconsole.conf'
+# Keys editing the search filter of a list: the erase keys drop its last
+# character, escape clears it.
+SEARCH_ERASE_KEYS = [curses.KEY_BACKSPACE, 127, 8]
+SEARCH_CLEAR_KEY = 27
+# Smallest CVM boot and data disk of a CE install, in GB.
+CE_MIN_DISK_GB = 200.0
+# Random reads of the disk benchmark placing CE disk roles.
+DISK_BENCH_READS = 32
+DISK_BENCH_READ_SIZE = 65536
+# Weights of the disk transports in the placement score.
+TRANSPORT_WEIGHTS = {'NVMe': 4.0, 'SAS': 2.0, 'SATA': 1.0, 'USB': 0.25}
+# Destructive write and read test of the disks failing the CE minimum
+# requirements. Disks behind one controller are tested a few at a time.
+# The test is an opt in preview, run with QUALIFY_DISKS=1 in the
+# environment of install.sh. Its results don't replace the minimum
+# requirement tests phoenix runs on the disks later.
+QUALIFY_SIZE = 268435456
+QUALIFY_BLOCK_SIZE = 1048576
+QUALIFY_PER_CONTROLLER = 4
+QUALIFY_DISKS_ENV = 'QUALIFY_DISKS'
+# Payloads on the boot media are read ahead in blocks of this size, into at
+# most this share of the memory available when the installer starts.
+PREFETCH_BLOCK_SIZE = 1048576
+PREFETCH_MEMORY_SHARE = 0.5
+# Downloads of the CE "ISO URL" field, fetched in chunks of
+# DOWNLOAD_CHUNK_SIZE bytes over parallel HTTP range requests.
+ESX_DOWNLOAD_DIR = '/esx_tmp'
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_CHUNK_SIZE = 16777216
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_RETRIES = 3
+# Checksums looked up next to a download, as <url>.<algorithm>.
+CHECKSUM_ALGORITHMS = ['sha256', 'sha1', 'md5']
+# Seconds the link and default route of the host network may take to come
+# up, polled every NETWORK_POLL_INTERVAL seconds.
+NETWORK_READY_TIMEOUT = 30
+NETWORK_POLL_INTERVAL = 0.05
+# Seconds the interfaces brought up to pick the host network one may take
+# to report a link.
+LINK_DETECT_TIMEOUT = 5
+SIOCADDRT = 0x890b
+SIOCGIFFLAGS = 0x8913
+SIOCSIFFLAGS = 0x8914
+SIOCSIFADDR = 0x8916
+SIOCSIFBRDADDR = 0x891a
+SIOCSIFNETMASK = 0x891c
+IFF_UP = 0x1
+RTF_UP = 0x1
+RTF_GATEWAY = 0x2
+# Runs of these keys are handled as one keystroke by widgets that coalesce
+# keys, see ElementHandler.read_repeats.
+COALESCED_KEYS = [curses.KEY_UP, curses.KEY_DOWN, curses.KEY_PPAGE,
+                  curses.KEY_NPAGE]
+PROBE_LABELS = [
+  ('factory_config', 'Existing factory config'),
+  ('svm_data', 'Existing CVM data'),
+  ('detect_params', 'Platform detection'),
+  ('system_manufacturer', 'System manufacturer'),
+]
+
+def run_in_daemon_threads(calls, timeout):
+  """
+  Runs each of the callables calls in a daemon thread and waits at most
+  timeout seconds for all of them. Returns a list with a (result, error)
+  tuple per call, or None for the calls still running. Calls hung on a dead
+  device are left behind without keeping the installer from exiting.
+  """
+  results = [None] * len(calls)
+  def _run(index, call):
+    try:
+      results[index] = (call(), None)
+    except Exception as e:
+      results[index] = (None, e)
+  threads = []
+  for index, call in enumerate(calls):
+    thread = threading.Thread(target=_run, args=(index, call))
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+  deadline = time.time() + timeout
+  for thread in threads:
+    thread.join(max(0, deadline - time.time()))
+  return [results[index] if not thread.is_alive() else None
+          for index, thread in enumerate(threads)]
+
+class LineCache(object):
+  """
+  Remembers the lines a widget drew, so redrawing it only draws the lines
+  that changed. A line is drawn again if the window doesn't show its first
+  character anymore, e.g. after the window was cleared, so lines starting
+  with a blank are always drawn.
+  """
+
+  def __init__(self, window):
+    self.window = window
+    self.lines = {}
+
+  def addstr(self, y, x, text, *args):
+    if (text and text[0] != ' ' and self.lines.get((y, x)) == (text, args) and
+        self.window.inch(y, x) & curses.A_CHARTEXT == ord(text[0])):
+      return
+    self.window.addstr(y, x, text, *args)
+    self.lines[(y, x)] = (text, args)
+
 class GuiParams(object):
   def __init__(self):
     self.node_position_choices = None
@@ -90,6 +214,847 @@ class GuiParams(object):
 
 gp = GuiParams()
 gui = None
+hardware_probes = None
+
+
+class DiskInventory(object):
+  """
+  Session wide cache of disk_info.collect_disk_info. Devices are probed in
+  parallel, each with a timeout. The snapshot is invalidated by block
+  uevents, by changes under /sys/block if uevents can't be received, and by
+  rescan().
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.generation = 0
+    self.snapshot = None
+    self.snapshot_generation = None
+    self.sysfs_signature = None
+    self.watching = None
+
+  def invalidate(self):
+    self.generation += 1
+
+  def rescan(self):
+    self.invalidate()
+    return self.get()
+
+  def get(self, disk_list_filter=None):
+    """
+    Returns the disks of the snapshot as a new dict of dev to disk info,
+    optionally only those in disk_list_filter.
+    """
+    with self.lock:
+      if self.watching is None:
+        self.watching = self._watch_uevents()
+      if not self.watching and self.sysfs_signature != self._get_sysfs_signature():
+        self.invalidate()
+      if self.snapshot is None or self.snapshot_generation != self.generation:
+        generation = self.generation
+        self.sysfs_signature = self._get_sysfs_signature()
+        self.snapshot = self._probe()
+        self.snapshot_generation = generation
+      disks = dict(self.snapshot)
+    if disk_list_filter is not None:
+      disks = dict([(dev, disks[dev]) for dev in disk_list_filter if dev in disks])
+    return disks
+
+  def _watch_uevents(self):
+    try:
+      sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                           NETLINK_KOBJECT_UEVENT)
+      sock.bind((os.getpid(), 1))
+    except (AttributeError, socket.error):
+      return False
+
+    def _watch():
+      while True:
+        try:
+          data = sock.recv(65536)
+        except socket.error:
+          # Fall back to comparing /sys/block.
+          self.watching = False
+          return
+        if b'\0SUBSYSTEM=block\0' in data:
+          self.invalidate()
+    thread = threading.Thread(target=_watch)
+    thread.daemon = True
+    thread.start()
+    return True
+
+  def _get_sysfs_signature(self):
+    signature = []
+    try:
+      for name in sorted(os.listdir('/sys/block')):
+        with open('/sys/block/%s/size' % name) as fd:
+          signature.append((name, fd.read().strip(),
+                            sorted(os.listdir('/sys/block/%s' % name))))
+    except (IOError, OSError):
+      return None
+    return signature
+
+  def _probe(self):
+    from hardware_inventory import disk_info
+    try:
+      devices = sorted([name for name in os.listdir('/sys/block')
+                        if not name.startswith(VIRTUAL_BLOCK_PREFIXES)])
+    except OSError:
+      return disk_info.collect_disk_info(skip_part_info=False)
+    if not devices:
+      return {}
+    # Don't wait for hung probes, their devices are left out.
+    results = run_in_daemon_threads(
+      [functools.partial(disk_info.collect_disk_info, disk_list_filter=[dev],
+                         skip_part_info=False) for dev in devices],
+      DISK_PROBE_TIMEOUT)
+    disks = {}
+    for dev, result in zip(devices, results):
+      if result is None:
+        ERROR("Probing disk %s timed out after %d seconds, leaving it out" %
+              (dev, DISK_PROBE_TIMEOUT))
+        continue
+      info, error = result
+      if error:
+        ERROR("Failed to probe disk %s: %s" % (dev, error))
+        continue
+      disks.update(info)
+    return disks
+
+disk_inventory = DiskInventory()
+
+
+class ImageCatalog(object):
+  """
+  Packaged AOS and hypervisor images, read once from the catalog generate_iso
+  writes into the images dir. Whatever the catalog doesn't describe is looked
+  up by scanning the media, at most once per kind of image.
+  """
+
+  def __init__(self, images_dir=IMAGES_DIR):
+    self.images_dir = images_dir
+    self.catalog = {}
+    self.nos_images = None
+    self.hyp_images = None
+    try:
+      with open(os.path.join(images_dir, IMAGE_CATALOG_NAME)) as fd:
+        self.catalog = json.load(fd)
+    except (IOError, OSError, ValueError):
+      pass
+
+  def get_nos(self):
+    """
+    Returns the packaged AOS images, scanning the media for them on first use.
+    """
+    if self.nos_images is None:
+      from images import get_packaged_nos
+      self.nos_images = get_packaged_nos()
+    return self.nos_images
+
+  def get_nos_version(self):
+    """
+    Returns the version of the packaged AOS, without scanning the media if the
+    catalog knows it.
+    """
+    aos = self.catalog.get('aos')
+    if aos and aos[0].get('version'):
+      return aos[0]['version']
+    return self.get_nos()[0].version
+
+  def get_hyp(self):
+    """
+    Returns the packaged hypervisor images.
+    """
+    if self.hyp_images is None:
+      from images import get_packaged_hyp, HypervisorImages
+      hypervisors = self.catalog.get('hypervisor')
+      if hypervisors:
+        self.hyp_images = [
+          HypervisorImages(os.path.join(self.images_dir, hyp['path']),
+                           hyp['type']) for hyp in hypervisors]
+      else:
+        self.hyp_images = get_packaged_hyp()
+    return self.hyp_images
+
+  def find_hyp(self, hyp_type):
+    """
+    Returns the packaged hypervisor image of type hyp_type, or None.
+    """
+    for image in self.get_hyp():
+      if image.hyp_type == hyp_type:
+        return image
+    return None
+
+  def get_payload_paths(self):
+    """
+    Returns the paths of the hypervisor images and then the AOS files the
+    catalog lists.
+    """
+    paths = [os.path.join(self.images_dir, hyp['path'])
+             for hyp in self.catalog.get('hypervisor', [])]
+    for aos in self.catalog.get('aos', []):
+      paths.extend(os.path.join(self.images_dir, name)
+                   for name in aos.get('files', []))
+    return paths
+
+image_catalog = ImageCatalog()
+
+
+def get_available_memory():
+  """
+  Returns MemAvailable of /proc/meminfo in bytes, or None if it's unknown.
+  """
+  try:
+    with open('/proc/meminfo') as fd:
+      for line in fd:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * 1024
+  except (IOError, OSError, ValueError, IndexError):
+    pass
+  return None
+
+
+class PayloadPrefetcher(object):
+  """
+  Reads the installer payloads off the boot media on a background thread
+  while the operator fills in the forms. Files are read one after the other,
+  in the order they were added, so slow media only ever seeks between files.
+  Files with a destination are copied there, the others are read into the
+  page cache as long as they fit in PREFETCH_MEMORY_SHARE of the available
+  memory, larger files are left to be read by the imaging.
+
+  Reads into the page cache are given up within a block once the file is
+  claimed or the prefetcher is stopped, so they never hold up the imaging
+  reading the media itself.
+  """
+
+  def __init__(self):
+    self.jobs = OrderedDict()
+    self.cond = threading.Condition()
+    self.thread = None
+    self.budget = None
+
+  def add(self, src, dst=None):
+    with self.cond:
+      if src not in self.jobs:
+        self.jobs[src] = {'dst': dst, 'status': 'queued', 'done': 0,
+                          'error': None, 'cancel': False}
+
+  def start(self):
+    if self.thread:
+      return
+    available = get_available_memory()
+    if available is not None:
+      self.budget = int(available * PREFETCH_MEMORY_SHARE)
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _next(self):
+    with self.cond:
+      for src, job in self.jobs.items():
+        if job['status'] == 'queued':
+          job['status'] = 'reading'
+          return src, job
+    return None, None
+
+  def _finish(self, job, status):
+    with self.cond:
+      job['status'] = status
+      self.cond.notify_all()
+
+  def _run(self):
+    while True:
+      src, job = self._next()
+      if not src:
+        return
+      try:
+        size = os.path.getsize(src)
+        if job['dst']:
+          self._copy(src, job)
+        elif self.budget is not None and size > self.budget:
+          self._finish(job, 'skipped')
+          continue
+        elif not self._read(src, job):
+          self._finish(job, 'claimed')
+          continue
+        if self.budget is not None:
+          self.budget -= size
+        self._finish(job, 'done')
+      except (IOError, OSError) as e:
+        job['error'] = str(e)
+        self._finish(job, 'failed')
+        ERROR("Failed to prefetch %s: %s" % (src, e))
+
+  def _read(self, src, job):
+    """
+    Reads src into the page cache, returns False if it was claimed before
+    the end.
+    """
+    buf = bytearray(PREFETCH_BLOCK_SIZE)
+    with open(src, 'rb', 0) as fd:
+      while not job['cancel']:
+        count = fd.readinto(buf)
+        if not count:
+          return True
+        job['done'] += count
+    return False
+
+  def _copy(self, src, job):
+    dst = job['dst']
+    if not os.path.exists(os.path.dirname(dst)):
+      os.makedirs(os.path.dirname(dst))
+    part = dst + '.part'
+    with open(src, 'rb') as fin:
+      with open(part, 'wb') as fout:
+        while True:
+          data = fin.read(PREFETCH_BLOCK_SIZE)
+          if not data:
+            break
+          fout.write(data)
+          job['done'] += len(data)
+    shutil.copymode(src, part)
+    os.rename(part, dst)
+
+  def claim(self, src):
+    """
+    Called when imaging needs src, a file or a directory holding files to
+    prefetch. Returns True once the prefetch of all of them has completed.
+    Copies being made are waited for, reads into the page cache are given
+    up after the block being read. Files not read yet are dropped from the
+    queue and False is returned, the caller reads them itself.
+    """
+    prefix = os.path.join(src, '')
+    with self.cond:
+      jobs = [job for path, job in self.jobs.items()
+              if path == src or path.startswith(prefix)]
+      for job in jobs:
+        if job['status'] == 'queued':
+          job['status'] = 'claimed'
+        elif not job['dst']:
+          job['cancel'] = True
+      while [job for job in jobs if job['status'] == 'reading']:
+        self.cond.wait()
+      return bool(jobs) and all([job['status'] == 'done' for job in jobs])
+
+  def stop(self):
+    """
+    Claims every payload left and waits for the prefetch thread to end,
+    once imaging reads the media itself.
+    """
+    with self.cond:
+      paths = list(self.jobs)
+    for path in paths:
+      self.claim(path)
+    if self.thread:
+      self.thread.join()
+
+payload_prefetcher = PayloadPrefetcher()
+
+
+def check_image_readable(path):
+  """
+  Checks the image at path is readable without reading all of it: it must be
+  a non-empty file whose first and last blocks can be read. Returns its
+  size. Raises IOError or OSError if it isn't readable.
+  """
+  st = os.stat(path)
+  if not stat.S_ISREG(st.st_mode) or not st.st_size:
+    raise IOError(errno.EINVAL, "not a non-empty file")
+  with open(path, 'rb', 0) as fd:
+    for offset in sorted(set([0, max(st.st_size - PREFETCH_BLOCK_SIZE, 0)])):
+      fd.seek(offset)
+      size = min(PREFETCH_BLOCK_SIZE, st.st_size - offset)
+      if len(fd.read(size)) != size:
+        raise IOError(errno.EIO, "short read at offset %d" % offset)
+  return st.st_size
+
+
+def get_network_interface(timeout=LINK_DETECT_TIMEOUT):
+  """
+  Returns the interface the host network is configured on: the first
+  physical interface with a link, trying eth0 first, else eth0 or the first
+  interface if none gets a link within timeout seconds. Interfaces that are
+  down are brought up to read their link, and down again unless chosen.
+  """
+  net_dir = '/sys/class/net'
+  names = sorted(name for name in os.listdir(net_dir)
+                 if os.path.exists(os.path.join(net_dir, name, 'device')))
+  if not names:
+    names = sorted(name for name in os.listdir(net_dir) if name != 'lo')
+  if not names:
+    return 'eth0'
+  if 'eth0' in names:
+    names.remove('eth0')
+    names.insert(0, 'eth0')
+  chosen = None
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  raised = []
+  try:
+    for name in names:
+      try:
+        if _set_interface_up(sock, name, True):
+          raised.append(name)
+      except OSError:
+        pass
+    start = time.time()
+    while chosen is None:
+      for name in names:
+        if has_carrier(name):
+          chosen = name
+          break
+      else:
+        if time.time() - start >= timeout:
+          chosen = names[0]
+        else:
+          time.sleep(NETWORK_POLL_INTERVAL)
+  finally:
+    for name in raised:
+      if name != chosen:
+        try:
+          _set_interface_up(sock, name, False)
+        except OSError:
+          pass
+    sock.close()
+  return chosen
+
+
+def has_carrier(iface):
+  try:
+    with open(os.path.join('/sys/class/net', iface, 'carrier')) as fd:
+      return fd.read().strip() == '1'
+  except (IOError, OSError):
+    # carrier isn't readable while the interface is down.
+    return False
+
+
+def _sockaddr_in(ip):
+  return struct.pack('HH4s8x', socket.AF_INET, 0, socket.inet_aton(ip))
+
+
+def _ifreq(iface, data):
+  return struct.pack('16s24s', iface.encode(), data)
+
+
+def _set_interface_up(sock, iface, up):
+  """
+  Brings iface up or down, returns whether its state changed.
+  """
+  ifreq = fcntl.ioctl(sock, SIOCGIFFLAGS, _ifreq(iface, b''))
+  flags = struct.unpack('16sH22x', ifreq)[1]
+  if bool(flags & IFF_UP) == up:
+    return False
+  flags = flags | IFF_UP if up else flags & ~IFF_UP
+  fcntl.ioctl(sock, SIOCSIFFLAGS, _ifreq(iface, struct.pack('H', flags)))
+  return True
+
+
+def configure_interface(iface, ip, subnet, gw):
+  """
+  Sets the address of iface, brings it up and adds the default route over
+  gw, like ifconfig and route would. Raises ValueError for invalid
+  addresses and OSError if the kernel refuses a change.
+  """
+  import ipaddress
+  network = ipaddress.IPv4Network(u'%s/%s' % (ip, subnet), strict=False)
+  ipaddress.IPv4Address(u'%s' % gw)
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    fcntl.ioctl(sock, SIOCSIFADDR, _ifreq(iface, _sockaddr_in(ip)))
+    fcntl.ioctl(sock, SIOCSIFNETMASK, _ifreq(iface, _sockaddr_in(subnet)))
+    fcntl.ioctl(sock, SIOCSIFBRDADDR,
+                _ifreq(iface, _sockaddr_in(str(network.broadcast_address))))
+    _set_interface_up(sock, iface, True)
+    # The route is bound to iface through rt_dev, a default route on another
+    # interface would make it fail with EEXIST otherwise. The trailing 0L
+    # pads the struct to its alignment, like the kernel's sizeof.
+    dev = ctypes.create_string_buffer(iface.encode())
+    rtentry = struct.pack('L16s16s16sHhLPhPLLH0L', 0,
+                          _sockaddr_in('0.0.0.0'), _sockaddr_in(gw),
+                          _sockaddr_in('0.0.0.0'), RTF_UP | RTF_GATEWAY, 0,
+                          0, 0, 0, ctypes.addressof(dev), 0, 0, 0)
+    try:
+      fcntl.ioctl(sock, SIOCADDRT, rtentry)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+  finally:
+    sock.close()
+
+
+def has_default_route(iface):
+  try:
+    with open('/proc/net/route') as fd:
+      for line in fd.readlines()[1:]:
+        fields = line.split()
+        if (fields[0] == iface and fields[1] == '00000000' and
+            int(fields[3], 16) & RTF_UP):
+          return True
+  except (IOError, OSError, ValueError, IndexError):
+    pass
+  return False
+
+
+def wait_for_network(iface, timeout=NETWORK_READY_TIMEOUT):
+  """
+  Waits until iface has a link and a default route. Returns the seconds it
+  took, or raises IOError after timeout seconds.
+  """
+  start = time.time()
+  while True:
+    link = has_carrier(iface)
+    if link and has_default_route(iface):
+      return time.time() - start
+    if time.time() - start >= timeout:
+      raise IOError("%s has no %s after %g seconds" % (
+        iface, "default route" if link else "link", timeout))
+    time.sleep(NETWORK_POLL_INTERVAL)
+
+
+class ImageDownload(object):
+  """
+  Downloads url to dst. Servers supporting range requests are read in chunks
+  over parallel connections, and the chunks already written are kept in
+  dst.part.json, so a download started again resumes where it stopped as
+  long as the server still has the same file, as told by its ETag or
+  Last-Modified header. The checksum is taken from the url fragment, e.g.
+  #sha256=<hex>, or else from <url>.<algorithm> on the server, and checked
+  before dst is created.
+  """
+
+  def __init__(self, url, dst, connections=DOWNLOAD_CONNECTIONS,
+               chunk_size=DOWNLOAD_CHUNK_SIZE):
+    self.url, _, fragment = url.partition('#')
+    self.checksum = None
+    algorithm, _, digest = fragment.partition('=')
+    if algorithm in CHECKSUM_ALGORITHMS and digest:
+      self.checksum = (algorithm, digest.lower())
+    self.dst = dst
+    self.part = dst + '.part'
+    self.state_path = dst + '.part.json'
+    self.connections = connections
+    self.chunk_size = chunk_size
+    self.lock = threading.Lock()
+    self.thread = None
+    self.status = 'queued'
+    self.size = None
+    self.done = 0
+    self.resumed = 0
+    self.error = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    try:
+      self._download()
+      self.status = 'done'
+    except Exception as e:
+      self.error = str(e)
+      self.status = 'failed'
+
+  def _open(self, url, start=None, end=None):
+    from urllib.request import Request, urlopen
+    headers = {}
+    if start is not None:
+      headers['Range'] = 'bytes=%d-%d' % (start, end)
+    return urlopen(Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT)
+
+  def _probe(self):
+    # A one byte range request tells both the size and the range support.
+    response = self._open(self.url, 0, 0)
+    try:
+      ranges = response.getcode() == 206
+      if ranges:
+        self.size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+      elif response.headers.get('Content-Length'):
+        self.size = int(response.headers['Content-Length'])
+      validator = (response.headers.get('ETag') or
+                   response.headers.get('Last-Modified'))
+    finally:
+      response.close()
+    return ranges, validator
+
+  def _fetch_checksum(self):
+    for algorithm in CHECKSUM_ALGORITHMS:
+      try:
+        response = self._open('%s.%s' % (self.url, algorithm))
+        try:
+          digest = response.read(4096).decode('ascii').split()[0].lower()
+        finally:
+          response.close()
+        int(digest, 16)
+      except (IOError, OSError, ValueError, IndexError):
+        continue
+      if len(digest) == hashlib.new(algorithm).digest_size * 2:
+        return (algorithm, digest)
+    return None
+
+  def _download(self):
+    self.status = 'connecting'
+    if not os.path.exists(os.path.dirname(self.dst)):
+      os.makedirs(os.path.dirname(self.dst))
+    ranges, validator = self._probe()
+    if not self.checksum:
+      self.checksum = self._fetch_checksum()
+    self.status = 'downloading'
+    if ranges and self.size:
+      self._fetch_ranges(validator)
+    else:
+      self._fetch_stream()
+    if self.checksum:
+      self.status = 'verifying'
+      self._verify()
+    os.rename(self.part, self.dst)
+    if os.path.exists(self.state_path):
+      os.remove(self.state_path)
+
+  def _load_state(self):
+    try:
+      with open(self.state_path) as fd:
+        return json.load(fd)
+    except (IOError, OSError, ValueError):
+      return None
+
+  def _save_state(self, state):
+    with open(self.state_path + '.tmp', 'w') as fd:
+      json.dump(state, fd)
+    os.rename(self.state_path + '.tmp', self.state_path)
+
+  def _fetch_ranges(self, validator):
+    state = {'url': self.url, 'size': self.size, 'validator': validator,
+             'chunk_size': self.chunk_size, 'chunks': []}
+    saved = self._load_state()
+    # Without a validator a changed file can't be told apart, so the
+    # download starts over.
+    if (validator and saved and os.path.exists(self.part) and
+        dict(saved, chunks=[]) == state):
+      state['chunks'] = saved['chunks']
+    else:
+      self._save_state(state)
+    count = (self.size + self.chunk_size - 1) // self.chunk_size
+    for index in state['chunks']:
+      self.done += min(self.chunk_size, self.size - index * self.chunk_size)
+    self.resumed = self.done
+    pending = [index for index in range(count)
+               if index not in state['chunks']]
+    fd = os.open(self.part, os.O_WRONLY | os.O_CREAT, 0o644)
+    pool = ThreadPoolExecutor(max_workers=max(1, min(self.connections,
+                                                     len(pending))))
+    futures = []
+    try:
+      os.ftruncate(fd, self.size)
+      futures = [pool.submit(self._fetch_chunk, fd, index, state)
+                 for index in pending]
+      for future in futures:
+        future.result()
+    except Exception:
+      # The chunks not started yet are left for the next attempt.
+      for future in futures:
+        future.cancel()
+      raise
+    finally:
+      pool.shutdown()
+      os.close(fd)
+
+  def _fetch_chunk(self, fd, index, state):
+    from http.client import HTTPException
+    start = index * self.chunk_size
+    end = min(start + self.chunk_size, self.size) - 1
+    for attempt in range(DOWNLOAD_RETRIES):
+      offset = start
+      try:
+        response = self._open(self.url, start, end)
+        try:
+          if response.getcode() != 206:
+            raise IOError("%s ignored a range request" % self.url)
+          while offset <= end:
+            data = response.read(min(PREFETCH_BLOCK_SIZE, end + 1 - offset))
+            if not data:
+              raise IOError("Connection closed at byte %d" % offset)
+            os.pwrite(fd, data, offset)
+            offset += len(data)
+            with self.lock:
+              self.done += len(data)
+        finally:
+          response.close()
+        break
+      except (IOError, OSError, HTTPException):
+        with self.lock:
+          self.done -= offset - start
+        if attempt == DOWNLOAD_RETRIES - 1:
+          raise
+    with self.lock:
+      state['chunks'].append(index)
+      self._save_state(state)
+
+  def _fetch_stream(self):
+    # Without range support the download can't be split nor resumed.
+    if os.path.exists(self.state_path):
+      os.remove(self.state_path)
+    response = self._open(self.url)
+    try:
+      with open(self.part, 'wb') as fd:
+        while True:
+          data = response.read(PREFETCH_BLOCK_SIZE)
+          if not data:
+            break
+          fd.write(data)
+          self.done += len(data)
+    finally:
+      response.close()
+    if self.size is not None and self.done != self.size:
+      raise IOError("Got %d of %d bytes" % (self.done, self.size))
+
+  def _verify(self):
+    algorithm, digest = self.checksum
+    h = hashlib.new(algorithm)
+    with open(self.part, 'rb') as fd:
+      while True:
+        data = fd.read(PREFETCH_BLOCK_SIZE)
+        if not data:
+          break
+        h.update(data)
+    if h.hexdigest() != digest:
+      os.remove(self.part)
+      if os.path.exists(self.state_path):
+        os.remove(self.state_path)
+      raise IOError("%s checksum mismatch, expected %s, got %s" %
+                    (algorithm, digest, h.hexdigest()))
+
+  def wait(self, label):
+    """
+    Prints the progress and throughput on the console until the download
+    ends. Raises IOError if it failed, and waits for the user to acknowledge
+    a download that couldn't be verified.
+    """
+    start = time.time()
+    while True:
+      self.thread.join(1)
+      elapsed = max(time.time() - start, 0.001)
+      line = "\r%s: %d MB" % (label, self.done // 1048576)
+      if self.size:
+        line += " of %d MB (%3d%%)" % (self.size // 1048576,
+                                       self.done * 100 // self.size)
+      line += ", %.1f MB/s, %s" % (
+        (self.done - self.resumed) / elapsed / 1048576, self.status)
+      sys.stdout.write(line.ljust(79))
+      sys.stdout.flush()
+      if not self.thread.is_alive():
+        break
+    sys.stdout.write("\n")
+    if self.error:
+      raise IOError(self.error)
+    if not self.checksum:
+      print("WARNING: No checksum found for %s, the download was not "
+            "verified." % self.url)
+      input("Press 'enter' to continue")
+
+
+def start_payload_prefetch():
+  """
+  Queues the payloads in the order imaging needs them: the driver package,
+  the hypervisor images and then the AOS package, and starts reading them.
+  Only payloads the image catalog describes are prefetched, so the media is
+  not scanned for them.
+  """
+  driver_package = os.path.join(IMAGES_DIR, DRIVER_PACKAGE_NAME)
+  if os.path.exists(driver_package):
+    payload_prefetcher.add(driver_package,
+                           os.path.join(DRIVERS_DIR, DRIVER_PACKAGE_NAME))
+  for path in image_catalog.get_payload_paths():
+    payload_prefetcher.add(path)
+  payload_prefetcher.start()
+
+
+class HardwareProbes(object):
+  """
+  Runs the hardware detection of get_params on background threads, so the
+  installer can draw its first page meanwhile. The svm data lookup shares
+  the thread of the factory config lookup, as it only runs without a factory
+  config. The start and end of every probe are kept as a timeline.
+  """
+
+  def __init__(self):
+    self.started = None
+    self.results = {}
+    self.timeline = {}
+    self.errors = []
+    self.threads = []
+    self.applied = False
+
+  def start(self):
+    self.started = time.time()
+    for target in [self._find_factory_config, self._detect_params,
+                   self._get_system_manufacturer]:
+      thread = threading.Thread(target=self._run, args=(target,))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def _run(self, target):
+    try:
+      target()
+    except Exception as e:
+      ERROR("Hardware detection failed: %s" % e)
+      self.errors.append(e)
+
+  def _probe(self, name, func, *args, **kwargs):
+    self.timeline[name] = [time.time() - self.started, None]
+    try:
+      self.results[name] = func(*args, **kwargs)
+    finally:
+      self.timeline[name][1] = time.time() - self.started
+    return self.results[name]
+
+  def _find_factory_config(self):
+    # Find existing nutanix partition and load existing factory config
+    # if it exists on that partition
+    if not self._probe('factory_config', sysUtil.find_factory_config):
+      self._probe('svm_data', sysUtil.find_svm_data)
+
+  def _detect_params(self):
+    # Auto-detect model and other parameters.
+    self._probe('detect_params', sysUtil.detect_params, gp.p_list,
+                throw_on_fatal=False, skip_esx_info=True)
+
+  def _get_system_manufacturer(self):
+    self._probe('system_manufacturer', get_system_manufacturer)
+
+  def done(self):
+    return not [thread for thread in self.threads if thread.is_alive()]
+
+  def get_status(self, name):
+    """
+    Returns a short description of the state of a probe.
+    """
+    if name not in self.timeline:
+      if name == 'svm_data' and 'factory_config' in self.results:
+        return 'skipped'
+      return 'failed' if self.done() else 'waiting'
+    start, end = self.timeline[name]
+    if end is None:
+      return 'running'
+    if name not in self.results:
+      return 'failed'
+    return 'done in %.1fs' % (end - start)
+
+  def wait(self):
+    """
+    Waits for all probes, records the timeline and raises the first error of
+    a probe.
+    """
+    for thread in self.threads:
+      thread.join()
+    try:
+      with open(PROBE_TIMELINE_PATH, 'w') as fd:
+        json.dump(self.timeline, fd, indent=2, sort_keys=True)
+    except (IOError, OSError) as e:
+      ERROR("Failed to record the hardware detection timeline: %s" % e)
+    if self.errors:
+      raise self.errors[0]
 
 
 class CheckBox(BaseCheckBox):
@@ -137,6 +1102,7 @@ class DropDown(CursesControl):
     self.selectedIndex = selectedIndex
     self.toggled = toggled
     self.callback_on_change = callback_on_change
+    self.drawn = LineCache(window)
     self._width = 0
     self.breakpoint = breakpoint
 
@@ -161,7 +1127,7 @@ class DropDown(CursesControl):
 
     # Expand text to be the size of the maximum field.
     text += " " * (self.width - len(text))
-    self.window.addstr(self.y, self.x, self.label, 0)
+    self.drawn.addstr(self.y, self.x, self.label, 0)
 
     if self.width > self.breakpoint:
       def find_break_point(text):
@@ -181,7 +1147,7 @@ class DropDown(CursesControl):
     y = self.y
     for text in texts:
       text += " " * (self.breakpoint - len(text))
-      self.window.addstr(y, self.x + len(self.label), text, color)
+      self.drawn.addstr(y, self.x + len(self.label), text, color)
       y = y + 1
 
   def keystroke(self, c):
@@ -215,9 +1181,12 @@ class TextViewBlock(BaseTextViewBlock):
   """
   TextViewBlock reads a file and displays the contents in a scroll-able block.
   """
+  coalesces_keys = True
+
   def __init__(self, window, y, x, filename, text, label, width, height, margin):
     BaseTextViewBlock.__init__(self, window, y, x, filename,
                                text, label, width, height, margin)
+    self.drawn = LineCache(window)
 
   def draw(self):
     y = self.y
@@ -226,7 +1195,7 @@ class TextViewBlock(BaseTextViewBlock):
       b2 = '*'
     else:
       b2 = ''
-    self.window.addstr(y,self.x,banner + self.label + banner + b2, self.width)
+    self.drawn.addstr(y,self.x,banner + self.label + banner + b2, self.width)
     y += 1
     for line in range(self.ycursor, self.ycursor+self.usable_height):
       txt = ''
@@ -241,23 +1210,23 @@ class TextViewBlock(BaseTextViewBlock):
         edges = '|'
       nblanks = self.usable_width - len(txt)
       margin = ' ' * self.margin
-      self.window.addstr(y, self.x, edges + margin + txt + self.blanks[0:nblanks]
-                         + margin + edges, self.width)
+      self.drawn.addstr(y, self.x, edges + margin + txt + self.blanks[0:nblanks]
+                        + margin + edges, self.width)
       y += 1
-    self.window.addstr(y,self.x,'*' * self.width,self.width)
+    self.drawn.addstr(y,self.x,'*' * self.width,self.width)
     #y += 1
     #statusmsg = 'ycur: %d' % self.ycursor
     #self.window.addstr(y,self.x,statusmsg,len(statusmsg))
 
-  def keystroke(self,c):
+  def keystroke(self, c, count=1):
     if c == curses.KEY_UP:
-      self.ycursor -= 1
+      self.ycursor -= count
     elif c == curses.KEY_DOWN:
-      self.ycursor += 1
+      self.ycursor += count
     elif c == curses.KEY_PPAGE:
-      self.ycursor -= self.usable_height - 1
+      self.ycursor -= (self.usable_height - 1) * count
     elif c == curses.KEY_NPAGE:
-      self.ycursor += self.usable_height - 1
+      self.ycursor += (self.usable_height - 1) * count
     else:
       return self.handler.NOTHING
     self.sanitize_ycursor()
@@ -272,22 +1241,32 @@ class TextViewBlock(BaseTextViewBlock):
 class ChoiceSelectBlock(CursesControl):
   """
   ChoiceSelectBlock displays a list of options in a scroll-able block.
+
+  Typing searches the options, case insensitively: the block only shows the
+  options starting with or containing what was typed, and moves the cursor
+  to the first one starting with it. Backspace shortens the search, escape
+  clears it. Keys given to set_keystroke_handler aren't searched for.
   """
+  coalesces_keys = True
+
   def __init__(self, window, y, x, choices, current, label, width, height,
                keys=None):
     CursesControl.__init__(self)
     self.window = window
+    self.drawn = LineCache(window)
     self.y = y
     self.x = x
     self.choices = choices
     self.label = label
     self.keys = keys
     self.set_keystroke_handler()
+    self.set_choice_decorator()
 
-    if len(self.keys) != len(self.choices):
+    if self.keys is not None and len(self.keys) != len(self.choices):
       raise Exception('Number of keys (%d) must match number of choices'
         ' (%d).' % (len(keys), len(choices)))
-    if current and current not in self.choices and current not in self.keys:
+    if (current and current not in self.choices and
+        (self.keys is None or current not in self.keys)):
       raise Exception('Current choice "%s" not in choice list.' % current)
     self.lastkey = 0
 
@@ -308,26 +1287,88 @@ class ChoiceSelectBlock(CursesControl):
       if len(txt) > self.usable_width:
         raise Exception('Option "%s" is wider than allowed (%d/%d).' % (txt,
           len(txt), self.usable_width))
+    # Indices of the choices shown, all of them unless searching.
+    self.view = list(range(len(self.choices)))
+    self.search = ''
+    # Lower cased choices in sorted order, for prefix lookups.
+    self.search_index = sorted([(txt.lower(), i)
+                                for i, txt in enumerate(self.choices)])
     if current:
       idx = (self.choices.index(current) if current in self.choices
         else self.keys.index(current))
-      # top
-      if idx < self.usable_height:
-        self.ytop = 0
-        self.wincursor = idx
-      # bottom
-      elif idx >= len(self.choices) - self.usable_height:
-        self.ytop = len(self.choices) - self.usable_height
-        self.wincursor = idx - self.ytop
-      # middle
-      else:
-        self.wincursor = self.usable_height / 2
-        self.ytop = idx - self.wincursor
+      self.show_position(idx)
     else:
       self.ytop = 0
       self.wincursor = 0
     self.blanks = ' ' * self.usable_width
 
+  def show_position(self, pos):
+    """
+    Moves the cursor to position pos of the view.
+    """
+    # top
+    if pos < self.usable_height:
+      self.ytop = 0
+    # bottom
+    elif pos >= len(self.view) - self.usable_height:
+      self.ytop = len(self.view) - self.usable_height
+    # middle
+    else:
+      self.ytop = pos - self.usable_height // 2
+    self.wincursor = pos - self.ytop
+
+  def move_cursor(self, pos):
+    """
+    Moves the cursor to position pos of the view, scrolling as little as
+    needed.
+    """
+    pos = max(0, min(pos, len(self.view) - 1))
+    if pos < self.ytop:
+      self.ytop = pos
+    elif pos >= self.ytop + self.usable_height:
+      self.ytop = pos - self.usable_height + 1
+    self.wincursor = pos - self.ytop
+
+  def find_matches(self, query):
+    """
+    Returns the indices of the choices starting with query and of those only
+    containing it.
+    """
+    prefix_matches = []
+    start = bisect.bisect_left(self.search_index, (query,))
+    for txt, i in self.search_index[start:]:
+      if not txt.startswith(query):
+        break
+      prefix_matches.append(i)
+    found = set(prefix_matches)
+    other_matches = [i for txt, i in self.search_index
+                     if i not in found and query in txt]
+    return prefix_matches, other_matches
+
+  def update_search(self, c):
+    selected = self.view[self.ytop + self.wincursor]
+    if c == SEARCH_CLEAR_KEY:
+      search = ''
+    elif c in SEARCH_ERASE_KEYS:
+      search = self.search[:-1]
+    else:
+      search = self.search + chr(c).lower()
+    if not search:
+      self.search = ''
+      self.view = list(range(len(self.choices)))
+      self.show_position(selected)
+      return
+    prefix_matches, other_matches = self.find_matches(search)
+    if not prefix_matches and not other_matches:
+      curses.beep()
+      return
+    self.search = search
+    self.view = sorted(prefix_matches + other_matches)
+    if prefix_matches:
+      self.show_position(self.view.index(min(prefix_matches)))
+    else:
+      self.show_position(0)
+
   def set_cursor(self, left, right):
     self.left_cursor = left
     self.right_cursor = right
@@ -337,10 +1378,18 @@ class ChoiceSelectBlock(CursesControl):
     self.keystrokes = keystrokes
     self.keystroke_handler = handler
 
+  def set_choice_decorator(self, decorator=None):
+    """
+    decorator(idx, txt) returns the text shown for choice idx. It is only
+    called for the choices visible in the block, when they are drawn.
+    """
+    self.choice_decorator = decorator
+
   def get_selected_data(self):
+    idx = self.view[self.ytop + self.wincursor]
     if self.keys:
-      return self.keys[self.ytop + self.wincursor]
-    return self.choices[self.ytop + self.wincursor]
+      return self.keys[idx]
+    return self.choices[idx]
 
   def draw(self):
     y = self.y
@@ -349,15 +1398,17 @@ class ChoiceSelectBlock(CursesControl):
       b2 = '*'
     else:
       b2 = ''
-    self.window.addstr(y,self.x,banner + self.label + banner + b2, self.width)
+    self.drawn.addstr(y,self.x,banner + self.label + banner + b2, self.width)
     y += 1
     #self.window.addstr(y,self.x,'ytop: %d, wincur: %d, usable_height: %d, selected: %s%s' %
     #                   (self.ytop, self.wincursor, self.usable_height, self.get_selected_data(), ' '*20))
     #y += 1
     for line in range(self.ytop, self.ytop + self.usable_height):
-      if line < len(self.choices):
+      if line < len(self.view):
         #txt = '%d/%d: ' % (line, len(self.choices))
-        txt = self.choices[line]
+        txt = self.choices[self.view[line]]
+        if self.choice_decorator:
+          txt = self.choice_decorator(self.view[line], txt)
       else:
         #txt = '%d' % (line)
         txt = ''
@@ -368,17 +1419,20 @@ class ChoiceSelectBlock(CursesControl):
       l = len(txt)
       if self.ytop != 0 and line == self.ytop:
         edges = '^'
-      elif (self.ytop + self.usable_height < len(self.choices) and
+      elif (self.ytop + self.usable_height < len(self.view) and
             line == self.ytop + self.usable_height - 1):
         edges = 'V'
       else:
         edges = '|'
-      self.window.addstr(y,self.x,edges + txt + edges,self.width)
+      self.drawn.addstr(y,self.x,edges + txt + edges,self.width)
       y += 1
       #self.window.addstr(y, self.x, 'usable_width: %d, l: %d' %
       #                   (self.usable_width, l))
       #y += 1
-    self.window.addstr(y,self.x,'*' * self.width,self.width)
+    footer = '*' * self.width
+    if self.search:
+      footer = ('** Search: %s ' % self.search + footer)[:self.width]
+    self.drawn.addstr(y,self.x,footer,self.width)
 
   def sanitize_ycursor(self):
     # assumption: we only ever adjust wincursor by 1
@@ -391,25 +1445,28 @@ class ChoiceSelectBlock(CursesControl):
     # check ytop after wincursor in case we adjusted it beyond bounds
     if self.ytop < 0:
       self.ytop = 0
-    if self.ytop + self.wincursor >= len(self.choices):
-      self.ytop = len(self.choices) - self.usable_height
-      self.wincursor = self.usable_height - 1
+    if self.ytop + self.wincursor >= len(self.view):
+      self.ytop = max(0, len(self.view) - self.usable_height)
+      self.wincursor = len(self.view) - 1 - self.ytop
 
-  def keystroke(self,c):
+  def keystroke(self, c, count=1):
     must_draw = False
     if self.keystroke_handler:
       must_draw = self.keystroke_handler(c, ping=True)
     self.lastkey = c
     if c == curses.KEY_UP:
-      self.wincursor -= 1
+      self.move_cursor(self.ytop + self.wincursor - count)
     elif c == curses.KEY_DOWN:
-      self.wincursor += 1
+      self.move_cursor(self.ytop + self.wincursor + count)
     elif c == curses.KEY_PPAGE:
-      self.ytop -= self.usable_height
+      self.ytop -= self.usable_height * count
     elif c == curses.KEY_NPAGE:
-      self.ytop += self.usable_height
+      self.ytop += self.usable_height * count
     elif c in self.keystrokes:
       self.keystroke_handler(c)
+    elif 32 < c < 127 or (self.search and
+                          c in SEARCH_ERASE_KEYS + [SEARCH_CLEAR_KEY]):
+      self.update_search(c)
     else:
       if must_draw:
         self.draw()
@@ -429,17 +1486,60 @@ class ElementHandler(BaseElementHandler):
 
   def __init__(self, window):
     BaseElementHandler.__init__(self, window)
+    self.idle_callbacks = []
+
+  def add_idle_callback(self, callback):
+    """
+    Calls callback whenever no key was pressed for IDLE_POLL_MS, until it is
+    removed.
+    """
+    self.idle_callbacks.append(callback)
+
+  def remove_idle_callback(self, callback):
+    if callback in self.idle_callbacks:
+      self.idle_callbacks.remove(callback)
+
+  def read_repeats(self, c):
+    """
+    Reads the input pending without blocking, as long as it repeats key c.
+    Returns how often c was pressed in a row.
+    """
+    count = 1
+    self.window.nodelay(True)
+    try:
+      while True:
+        repeat = self.window.getch()
+        if repeat == curses.ERR:
+          break
+        if repeat != c:
+          curses.ungetch(repeat)
+          break
+        count += 1
+    finally:
+      self.window.nodelay(False)
+    return count
 
   def process(self):
     y = 0
     while 1:
-      self.window.refresh()
+      # Batch the changes of the last event into one terminal update.
+      self.window.noutrefresh()
+      curses.doupdate()
+      self.window.timeout(IDLE_POLL_MS if self.idle_callbacks else -1)
       c = self.window.getch()
+      if c == curses.ERR:
+        for callback in list(self.idle_callbacks):
+          callback()
+        continue
       # self.window.addstr(y,0,str(c)+"   ")
       y = (y+1) % 10
       current_index = self.get_focused_element_index()
       current_ele = self.elements[current_index]
-      action = current_ele.keystroke(c)
+      if c in COALESCED_KEYS and getattr(current_ele, 'coalesces_keys', False):
+        # Auto-repeat queues a key many times, move once for all of them.
+        action = current_ele.keystroke(c, self.read_repeats(c))
+      else:
+        action = current_ele.keystroke(c)
       if action == self.EXIT:
         self.lastControl = current_ele
         return
@@ -464,6 +1564,54 @@ class ElementHandler(BaseElementHandler):
             newIndex = (newIndex-1) % len(self.elements)
           self.elements[newIndex].set_focus(True)
 
+def list_keymap_dirs():
+  """
+  Lists the console keymaps found in KEYMAP_DIRS, as localectl does.
+  """
+  keymaps = set()
+  for keymap_dir in KEYMAP_DIRS:
+    for root, dirs, files in os.walk(keymap_dir):
+      dirs[:] = [name for name in dirs if name != 'include']
+      for name in files:
+        for suffix in KEYMAP_SUFFIXES:
+          if name.endswith(suffix):
+            keymaps.add(name[:-len(suffix)])
+  return sorted(keymaps)
+
+def get_keymaps():
+  """
+  Returns the console keymaps from the keymap dirs, and from localectl as a
+  last resort.
+  """
+  keymaps = list_keymap_dirs()
+  if keymaps:
+    return keymaps
+  ret,out,err = shell.shell_cmd(["/bin/localectl list-keymaps"])
+  if ret or err:
+    raise Exception('Could not retrieve list of keymaps.')
+  return out.split('\n')
+
+def get_current_keymap():
+  """
+  Returns the VC keymap set in vconsole.conf, asking localectl if the file
+  can't be read.
+  """
+  try:
+    with open(VCONSOLE_CONF) as fd:
+      lines = fd.read().splitlines()
+  except (IOError, OSError):
+    ret,out,err = shell.shell_cmd(
+      ["/bin/localectl | grep 'VC Keymap' | awk '{print $3}'"])
+    if ret or err:
+      raise Exception('Could not determine current keymap.')
+    return out.strip()
+  keymap = ''
+  for line in lines:
+    key, _, value = line.strip().partition('=')
+    if key.strip() == 'KEYMAP':
+      keymap = value.strip().strip('"\'')
+  return keymap
+
 class LocaleGui(object):
   class LocaleParams(object):
     def __init__(self):
@@ -477,21 +1625,20 @@ class LocaleGui(object):
     self.isFirst = True
     self.page = 0
     self.finalPage = 1
-    ret,out,err = shell.shell_cmd(["/bin/localectl list-keymaps"])
-    if ret or err:
-      raise Exception('Could not retrieve list of keymaps.')
-    self.kb_layouts = out.split('\n')
-    ret,out,err = shell.shell_cmd(
-      ["/bin/localectl | grep 'VC Keymap' | awk '{print $3}'"])
-    if ret or err:
-      raise Exception('Could not determine current keymap.')
-    self.kb_current = out.strip()
+    self.kb_layouts = get_keymaps()
+    self.kb_current = get_current_keymap()
+    if self.kb_current not in self.kb_layouts:
+      self.kb_current = None
     self.ce_drives = self.get_drive_list()
+    self.qualifier = None
+    if self.ce_drives and os.environ.get(QUALIFY_DISKS_ENV):
+      # Page 2 qualifies the disks.
+      self.finalPage = 2
 
   def get_drive_list(self):
     import sysUtil
     import minimum_reqs
-    disks = disk_info.collect_disk_info()
+    disks = disk_inventory.get()
     boot_disk = sysUtil.find_boot_disk(None)
     if boot_disk:
       if boot_disk.dev in disks:
@@ -509,9 +1656,36 @@ class LocaleGui(object):
     lp.locale = self.kdb_layout.get_selected_data()
     return lp
 
+  def poll_qualification(self):
+    self.qualify_view.text = self.qualifier.get_lines(self.qualify_width)
+    self.qualify_view.draw()
+    if self.qualifier.done():
+      self.handler.remove_idle_callback(self.poll_qualification)
+
+  def cancel_qualification(self, ignore):
+    self.qualifier.stop()
+    return self.handler.EXIT
+
+  def proceed_after_qualification(self, ignore):
+    if not self.qualifier.done():
+      return self.handler.HANDLED
+    failed = self.qualifier.get_failed()
+    if failed and not self.qualify_confirmed:
+      # The first Proceed only shows which disks didn't pass.
+      self.qualify_confirmed = True
+      line = ("WARNING: %s did not pass, press Proceed again to install"
+              " anyway." % ', '.join([os.path.basename(target)
+                                      for target in failed]))
+      self.window.addnstr(self.qualify_warning_y, self.qualify_x, line,
+                          self.max_x - self.qualify_x)
+      return self.handler.HANDLED
+    return self.proceedPage(None)
+
   def proceedPage(self, ignore):
     if self.page == 0:
       pass
+    elif self.page < self.finalPage:
+      pass
     # add additional page logic above
     elif self.page == self.finalPage:
       return self.handler.EXIT
@@ -524,7 +1698,7 @@ class LocaleGui(object):
     self.window.clear()
     y, x = self.init_header()
     self.init_page(y,x)
-    self.stdscr.refresh()
+    self.stdscr.noutrefresh()
     self.handler.elements[0].set_focus(True)
     return self.handler.HANDLED
 
@@ -560,6 +1734,31 @@ class LocaleGui(object):
     return y, x
 
   def init_page(self, y, x):
+    if self.page == 2:
+      self.window.addstr(y,x, "Testing the disks, this destroys the data on"
+        " them. Proceed once all tests are done.")
+      y += 2
+      self.qualify_width = self.max_x - x - 4
+      height = min(len(self.ce_drives) + 2, self.max_y - y - 5)
+      self.qualifier = DiskQualifier(['/dev/%s' % disk.dev
+                                      for disk in self.ce_drives])
+      self.qualify_view = TextViewBlock(self.window, y, x, None,
+        self.qualifier.get_lines(self.qualify_width), 'Disk Qualification',
+        self.qualify_width + 4, height, 1)
+      self.handler.add(self.qualify_view, bool(height > 8))
+      y += height + 1
+      self.qualify_x = x
+      self.qualify_warning_y = y + 2
+      self.qualify_confirmed = False
+      cancelButton = Button(self.window,y,x,"Cancel",
+                            self.cancel_qualification)
+      self.handler.add(cancelButton)
+      self.proceedButton = Button(self.window,y,x+10,"Proceed",
+                                  self.proceed_after_qualification)
+      self.handler.add(self.proceedButton)
+      self.qualifier.start()
+      self.handler.add_idle_callback(self.poll_qualification)
+      return
     if self.page != 1:
       return
 
@@ -593,7 +1792,7 @@ class LocaleGui(object):
           longest_disk = len(d)
       height = min(len(disk_text)+2,10)
       self.diskwarning = TextViewBlock(self.window,y,x,None,disk_text,'Disks',
-                                       longest_disk+3,height)
+                                       longest_disk+3,height,0)
       self.handler.add(self.diskwarning,bool(height>8))
       y += height + 1
 
@@ -626,7 +1825,478 @@ class LocaleGui(object):
     else:
       return self.handler.lastControl == self.proceedButton
 
+class DiskRoles(object):
+  """
+  Roles of the disks in the CE disk selection, keyed by device. Looking up,
+  setting and clearing the role of a disk are O(1), the status line is only
+  rebuilt after a change.
+  """
+  ISO = 'I'
+  HYP_BOOT = 'H'
+  CVM_BOOT = 'C'
+  CVM_DATA = 'D'
+  # Roles of choose_ce_disk_defaults.
+  DEFAULT_KEYS = [(ISO, 'PHOENIX_ISO'), (HYP_BOOT, 'HYP_BOOT'),
+                  (CVM_BOOT, 'CVM_BOOT'), (CVM_DATA, 'CVM_DATA')]
+
+  def __init__(self):
+    self.roles = {}
+    self.devices = dict([(role, OrderedDict()) for role, _ in self.DEFAULT_KEYS])
+    self.status = None
+
+  def load_defaults(self, disk_defaults, keep_iso=False):
+    """
+    Replaces the roles with those of choose_ce_disk_defaults, optionally
+    keeping the ISO installer disks.
+    """
+    for role, key in self.DEFAULT_KEYS:
+      if keep_iso and role == self.ISO:
+        continue
+      for dev in self.get_devices(role):
+        self.clear(dev)
+      if "error" not in disk_defaults:
+        for dev in disk_defaults[key]:
+          self.set(dev, role)
+
+  def get(self, dev):
+    return self.roles.get(dev)
+
+  def get_devices(self, role):
+    return list(self.devices[role])
+
+  def count(self, role):
+    return len(self.devices[role])
+
+  def set(self, dev, role):
+    self.clear(dev)
+    self.roles[dev] = role
+    self.devices[role][dev] = True
+    self.status = None
+
+  def clear(self, dev):
+    role = self.roles.pop(dev, None)
+    if role:
+      del self.devices[role][dev]
+      self.status = None
+
+  def clear_oldest(self, role):
+    self.clear(next(iter(self.devices[role])))
+
+  def get_status(self):
+    if self.status is None:
+      if not self.devices[self.HYP_BOOT]:
+        self.status = "Installation cannot proceed without selecting a hypervisor boot disk."
+      elif not self.devices[self.CVM_BOOT]:
+        self.status = "Installation cannot proceed without selecting one (or two) CVM boot disk(s)."
+      elif not self.devices[self.CVM_DATA]:
+        self.status = "Installation cannot proceed without selecting one or more data disks."
+      else:
+        self.status = "Hypervisor Boot: {}, CVM Boot: {}, Data: {}".format(
+          self.get_devices(self.HYP_BOOT), self.get_devices(self.CVM_BOOT),
+          self.get_devices(self.CVM_DATA))
+    return self.status
+
+
+def benchmark_disk(dev):
+  """
+  Returns the throughput of a few random direct reads of a disk in MB/s, or
+  None if it can't be read.
+  """
+  try:
+    fd = os.open('/dev/%s' % dev, os.O_RDONLY | getattr(os, 'O_DIRECT', 0))
+  except OSError:
+    return None
+  try:
+    blocks = os.lseek(fd, 0, os.SEEK_END) // DISK_BENCH_READ_SIZE
+    if not blocks:
+      return None
+    # O_DIRECT needs an aligned buffer, mmap is page aligned.
+    buf = mmap.mmap(-1, DISK_BENCH_READ_SIZE)
+    try:
+      rand = random.Random(dev)
+      start = time.time()
+      for _ in range(DISK_BENCH_READS):
+        os.preadv(fd, [buf], rand.randrange(blocks) * DISK_BENCH_READ_SIZE)
+      elapsed = max(time.time() - start, 1e-6)
+    finally:
+      buf.close()
+  except (OSError, AttributeError):
+    return None
+  finally:
+    os.close(fd)
+  return DISK_BENCH_READS * DISK_BENCH_READ_SIZE / 1048576.0 / elapsed
+
+def get_queue_depth(dev):
+  for path in ['/sys/block/%s/device/queue_depth' % dev,
+               '/sys/block/%s/queue/nr_requests' % dev]:
+    try:
+      with open(path) as fd:
+        return int(fd.read().strip())
+    except (IOError, OSError, ValueError):
+      pass
+  return 1
+
+def get_transport(disk):
+  if disk.isUSB:
+    return 'USB'
+  if disk.dev.startswith('nvme'):
+    return 'NVMe'
+  if os.path.exists('/sys/block/%s/device/sas_address' % disk.dev):
+    return 'SAS'
+  return 'SATA'
+
+
+class DiskPlacement(object):
+  """
+  Places the CE disk roles by performance. choose_ce_disk_defaults still
+  picks the ISO and hypervisor boot disks and the disks usable by the CVM.
+  Of those, the SSDs of at least CE_MIN_DISK_GB with the best score become
+  the CVM boot disks, which also hold the oplog, and the others data disks.
+
+  A disk scores its benchmarked read throughput, weighted by its transport
+  and queue depth. Scores are kept for the session.
+  """
+
+  def __init__(self):
+    self.scores = {}
+
+  def score(self, disks):
+    pending = [disk for disk in disks
+               if (disk.dev, disk.serial) not in self.scores]
+    if pending:
+      results = run_in_daemon_threads(
+        [functools.partial(benchmark_disk, disk.dev) for disk in pending],
+        DISK_PROBE_TIMEOUT)
+      for disk, result in zip(pending, results):
+        throughput = result[0] if result else None
+        transport = get_transport(disk)
+        queue_depth = get_queue_depth(disk.dev)
+        # Disks that couldn't be benchmarked count as 1 MB/s, slower than
+        # any working disk, and are weighed by transport and queue depth
+        # like the others.
+        score = ((throughput or 1.0) * TRANSPORT_WEIGHTS[transport] *
+                 (1 + math.log(max(queue_depth, 1), 2) / 8))
+        self.scores[(disk.dev, disk.serial)] = {
+          'throughput': throughput, 'transport': transport,
+          'queue_depth': queue_depth, 'score': score}
+    return dict([(disk.dev, self.scores[(disk.dev, disk.serial)])
+                 for disk in disks])
+
+  def describe(self, dev, score):
+    throughput = ('%d MB/s' % score['throughput'] if score['throughput']
+                  else 'no benchmark')
+    return '%s (%s, %s, qd %d)' % (dev, score['transport'], throughput,
+                                   score['queue_depth'])
+
+  def place(self, disks):
+    """
+    Returns the disk roles in the format of choose_ce_disk_defaults, and a
+    line explaining the choice of the CVM boot disks or None.
+    """
+    from hardware_inventory import disk_info
+    disk_defaults = disk_info.choose_ce_disk_defaults(disks)
+    if "error" in disk_defaults or not disk_defaults['CVM_BOOT']:
+      return disk_defaults, None
+    usable = disk_defaults['CVM_BOOT'] + disk_defaults['CVM_DATA']
+    scores = self.score([disks[dev] for dev in usable])
+    candidates = sorted([dev for dev in usable if disks[dev].isSSD and
+                         disks[dev].size >= CE_MIN_DISK_GB],
+                        key=lambda dev: scores[dev]['score'], reverse=True)
+    if not candidates:
+      return disk_defaults, None
+    placement = dict(disk_defaults)
+    placement['CVM_BOOT'] = candidates[:len(disk_defaults['CVM_BOOT'])]
+    placement['CVM_DATA'] = [dev for dev in usable
+                             if dev not in placement['CVM_BOOT']]
+    chosen = ', '.join([self.describe(dev, scores[dev])
+                        for dev in placement['CVM_BOOT']])
+    others = candidates[len(placement['CVM_BOOT']):]
+    if others:
+      rationale = 'CVM boot %s outscores %s' % (
+        chosen, self.describe(others[0], scores[others[0]]))
+    else:
+      rationale = 'CVM boot %s, the only eligible SSD(s)' % chosen
+    return placement, rationale
+
+disk_placement = DiskPlacement()
+
+
+def get_disk_controller(path):
+  """
+  Returns the controller a disk is attached to: the SCSI host or NVMe
+  controller of a block device, the device holding a regular file.
+  """
+  st = os.stat(path)
+  if not stat.S_ISBLK(st.st_mode):
+    return 'dev%d' % st.st_dev
+  name = os.path.basename(os.path.realpath(path))
+  device = os.path.realpath('/sys/block/%s/device' % name)
+  match = re.search(r'/(host\d+|nvme\d+)(/|$)', device)
+  return match.group(1) if match else name
+
+
+class DiskQualifier(object):
+  """
+  Qualifies disks by writing and reading back QUALIFY_SIZE bytes of each,
+  destroying the data there. All disks are tested concurrently, at most
+  per_controller at once behind the same controller. The progress,
+  throughput and latency of every disk can be read while the tests run.
+  Disks that don't support direct IO are tested through the page cache and
+  end up unverified rather than passed.
+
+  Targets are paths of block devices, loop devices or regular files.
+  """
+
+  def __init__(self, targets, per_controller=QUALIFY_PER_CONTROLLER,
+               size=QUALIFY_SIZE, block_size=QUALIFY_BLOCK_SIZE):
+    self.per_controller = per_controller
+    self.size = size
+    self.block_size = block_size
+    self.threads = []
+    self.stopped = threading.Event()
+    self.results = OrderedDict()
+    for target in targets:
+      self.results[target] = {'status': 'queued', 'done': 0, 'total': 0,
+                              'write_mbps': None, 'read_mbps': None,
+                              'latency_ms': None, 'max_latency_ms': None,
+                              'error': None}
+
+  def start(self):
+    controllers = {}
+    for target in self.results:
+      try:
+        controller = get_disk_controller(target)
+      except OSError:
+        controller = target
+      if controller not in controllers:
+        controllers[controller] = threading.Semaphore(self.per_controller)
+      thread = threading.Thread(target=self._run,
+                                args=(target, controllers[controller]))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def done(self):
+    return not [thread for thread in self.threads if thread.is_alive()]
+
+  def stop(self, timeout=DISK_PROBE_TIMEOUT):
+    """
+    Stops the tests after the blocks they are writing or reading, and waits
+    at most timeout seconds for them.
+    """
+    self.stopped.set()
+    deadline = time.time() + timeout
+    for thread in self.threads:
+      thread.join(max(0, deadline - time.time()))
+
+  def get_failed(self):
+    """
+    Returns the targets whose test failed or couldn't be verified.
+    """
+    return [target for target, result in self.results.items()
+            if result['status'] in ('failed', 'unverified')]
+
+  def _run(self, target, slot):
+    result = self.results[target]
+    with slot:
+      if self.stopped.is_set():
+        result['status'] = 'stopped'
+        return
+      result['status'] = 'testing'
+      try:
+        direct = self._qualify(target, result)
+      except Exception as e:
+        result['error'] = str(e)
+        result['status'] = 'failed'
+        ERROR("Qualification of disk %s failed: %s" % (target, e))
+        return
+      if self.stopped.is_set():
+        result['status'] = 'stopped'
+      elif not direct:
+        result['error'] = 'no direct IO, read back from the page cache'
+        result['status'] = 'unverified'
+        ERROR("Qualification of disk %s is unverified: %s" %
+              (target, result['error']))
+      else:
+        result['status'] = 'passed'
+
+  def _open(self, target):
+    """
+    Returns a descriptor of target and whether it uses direct IO.
+    """
+    try:
+      return os.open(target, os.O_RDWR | getattr(os, 'O_DIRECT', 0)), True
+    except OSError as e:
+      if e.errno != errno.EINVAL:
+        raise
+      # Files on filesystems like tmpfs don't support direct IO.
+      return os.open(target, os.O_RDWR), False
+
+  def _qualify(self, target, result):
+    """
+    Tests target, returns whether the test used direct IO.
+    """
+    fd, direct = self._open(target)
+    try:
+      size = min(self.size, os.lseek(fd, 0, os.SEEK_END))
+      blocks = size // self.block_size
+      if not blocks:
+        raise Exception('disk is smaller than %d bytes' % self.block_size)
+      result['total'] = 2 * blocks * self.block_size
+      # Direct IO needs aligned buffers, mmap is page aligned.
+      pattern = mmap.mmap(-1, self.block_size)
+      pattern.write(os.urandom(self.block_size))
+      buf = mmap.mmap(-1, self.block_size)
+      latencies = []
+      start = time.time()
+      for block in range(blocks):
+        if self.stopped.is_set():
+          return direct
+        io_start = time.time()
+        os.pwritev(fd, [pattern], block * self.block_size)
+        latencies.append(time.time() - io_start)
+        result['done'] += self.block_size
+      os.fsync(fd)
+      result['write_mbps'] = (blocks * self.block_size / 1048576.0 /
+                              max(time.time() - start, 1e-6))
+      start = time.time()
+      for block in range(blocks):
+        if self.stopped.is_set():
+          return direct
+        io_start = time.time()
+        os.preadv(fd, [buf], block * self.block_size)
+        latencies.append(time.time() - io_start)
+        if buf[:] != pattern[:]:
+          raise Exception('data read back at offset %d differs from the data'
+                          ' written' % (block * self.block_size))
+        result['done'] += self.block_size
+        result['read_mbps'] = ((block + 1) * self.block_size / 1048576.0 /
+                               max(time.time() - start, 1e-6))
+      result['latency_ms'] = 1000.0 * sum(latencies) / len(latencies)
+      result['max_latency_ms'] = 1000.0 * max(latencies)
+    finally:
+      os.close(fd)
+    return direct
+
+  def get_lines(self, width):
+    """
+    Returns a line describing the state of every disk, at most width long.
+    """
+    lines = []
+    for target, result in self.results.items():
+      progress = float(result['done']) / result['total'] if result['total'] else 0
+      bar = '#' * int(progress * 10) + '.' * (10 - int(progress * 10))
+      line = "%-12s [%s] %3d%% %-7s" % (os.path.basename(target), bar,
+                                         100 * progress, result['status'])
+      if result['write_mbps'] is not None:
+        line += " W %d MB/s" % result['write_mbps']
+      if result['read_mbps'] is not None:
+        line += " R %d MB/s" % result['read_mbps']
+      if result['latency_ms'] is not None:
+        line += " lat %.1f/%.1f ms" % (result['latency_ms'],
+                                       result['max_latency_ms'])
+      if result['error']:
+        line += " " + result['error']
+      lines.append(line[:width])
+    return lines
+
+
+def check_disk_qualifier(work_dir, size=8388608, block_size=1048576):
+  """
+  Checks DiskQualifier against sparse files in work_dir and, when run as
+  root with losetup installed, a loop device backed by one. Prints a line
+  per check and returns whether all passed.
+  """
+  paths = []
+
+  def _sparse_file(size):
+    path = os.path.join(work_dir, 'qualify-%s.img' % uuid4().hex[:8])
+    with open(path, 'wb') as fd:
+      fd.truncate(size)
+    paths.append(path)
+    return path
+
+  def _qualify(targets, per_controller=QUALIFY_PER_CONTROLLER,
+               size=size, stop=False):
+    qualifier = DiskQualifier(targets, per_controller=per_controller,
+                              size=size, block_size=block_size)
+    most_testing = 0
+    qualifier.start()
+    if stop:
+      qualifier.stop()
+    while not qualifier.done():
+      most_testing = max(most_testing, len([
+        result for result in qualifier.results.values()
+        if result['status'] == 'testing']))
+      time.sleep(0.001)
+    return qualifier, most_testing
+
+  def _check_file():
+    qualifier, _ = _qualify([_sparse_file(size)])
+    result = list(qualifier.results.values())[0]
+    return (result['status'] in ('passed', 'unverified') and
+            result['done'] == result['total'] == 2 * size and
+            result['read_mbps'] is not None)
+
+  def _check_small_file():
+    qualifier, _ = _qualify([_sparse_file(block_size // 2)])
+    result = list(qualifier.results.values())[0]
+    return result['status'] == 'failed' and 'smaller' in result['error']
+
+  def _check_per_controller():
+    # Files of one filesystem are behind the same controller.
+    targets = [_sparse_file(size) for _ in range(4)]
+    qualifier, most_testing = _qualify(targets, per_controller=1)
+    return most_testing == 1 and all([
+      result['status'] in ('passed', 'unverified')
+      for result in qualifier.results.values()])
+
+  def _check_stop():
+    qualifier, _ = _qualify([_sparse_file(64 * size)], size=64 * size,
+                            stop=True)
+    result = list(qualifier.results.values())[0]
+    return result['status'] == 'stopped' and result['done'] < result['total']
+
+  def _check_loop_device():
+    if os.geteuid() != 0 or not shutil.which('losetup'):
+      return None
+    ret, out, err = shell.shell_cmd(['losetup --find --show %s' %
+                                     _sparse_file(size)], fatal=False)
+    if ret:
+      return None
+    loop_dev = out.strip()
+    try:
+      qualifier, _ = _qualify([loop_dev])
+      return list(qualifier.results.values())[0]['status'] == 'passed'
+    finally:
+      shell.shell_cmd(['losetup -d %s' % loop_dev], fatal=False)
+
+  checks = [('sparse file written and read back', _check_file),
+            ('file smaller than a block fails', _check_small_file),
+            ('one test at a time per controller', _check_per_controller),
+            ('stop ends the test', _check_stop),
+            ('loop device written and read back', _check_loop_device)]
+  passed = True
+  try:
+    for name, check in checks:
+      try:
+        ok = check()
+      except Exception as e:
+        print("%s: %s" % (name, e))
+        ok = False
+      print("%-40s %s" % (name, {True: 'ok', False: 'FAILED',
+                                 None: 'skipped'}[ok]))
+      passed = passed and ok is not False
+  finally:
+    for path in paths:
+      os.remove(path)
+  return passed
+
+
 class CEGui(object):
+  # Page 0 shows the hardware detection of get_params while it runs.
+  shows_hardware_probes = True
+
   def __init__(self):
     self.skip_get_params = False
     self.isFirst = True
@@ -635,9 +2305,11 @@ class CEGui(object):
     self.DISK_MODEL_LENGTH = 20
 
   def get_extra_params(self):
-    ahv_ver = os.path.basename(get_packaged_hyp()[0].path)[:-4]
+    from images import HypervisorImages
+    packaged_hyp = image_catalog.get_hyp()[0]
+    ahv_ver = os.path.basename(packaged_hyp.path)[:-4]
     if self.hyp_select.get_selected() == 'AHV ({})'.format(ahv_ver):
-      self.hypervisor = get_packaged_hyp()[0]
+      self.hypervisor = packaged_hyp
     elif self.hyp_select.get_selected() == 'ESXi':
       gp.p_list.esx_path = self.hyp_esx_path.get_displayed_text()
       self.hypervisor = HypervisorImages(gp.p_list.esx_path, "esx")
@@ -662,7 +2334,7 @@ class CEGui(object):
     self.window.clear()
     y, x = self.init_header()
     self.init_page(y, x)
-    self.stdscr.refresh()
+    self.stdscr.noutrefresh()
     self.handler.elements[0].set_focus(True)
     return self.handler.HANDLED
 
@@ -683,7 +2355,7 @@ class CEGui(object):
     self.window.clear()
     y, x = self.init_header()
     self.init_page(y,x)
-    self.stdscr.refresh()
+    self.stdscr.noutrefresh()
     self.handler.elements[0].set_focus(True)
     return self.handler.HANDLED
 
@@ -707,15 +2379,76 @@ class CEGui(object):
 
     self.handler = ElementHandler(self.window)
 
-    self.proceedPage(None)
+    if hardware_probes and not hardware_probes.applied:
+      self.handler.add_idle_callback(self.poll_hardware_probes)
+      y, x = self.init_header()
+      self.init_page(y, x)
+      self.stdscr.noutrefresh()
+    else:
+      self.proceedPage(None)
+
+  def draw_hardware_probes(self):
+    y = self.probes_y
+    for name, label in PROBE_LABELS:
+      line = "{} : {}".format(label.ljust(24),
+                              hardware_probes.get_status(name).ljust(16))
+      self.window.addnstr(y, self.probes_x, line, self.max_x - self.probes_x)
+      y += 1
+
+  def draw_probe_text(self, text):
+    for line in text.splitlines():
+      if self.probes_text_y >= self.max_y:
+        break
+      self.window.addnstr(self.probes_text_y, self.probes_x, line,
+                          self.max_x - self.probes_x)
+      self.probes_text_y += 1
+
+  def poll_hardware_probes(self):
+    self.draw_hardware_probes()
+    if not hardware_probes.done():
+      return
+    self.handler.remove_idle_callback(self.poll_hardware_probes)
+    self.probes_text_y = self.probes_y + len(PROBE_LABELS) + 3
+    probe_error = None
+    try:
+      hardware_probes.wait()
+    except Exception as e:
+      # The results of the other probes are still applied, whatever wasn't
+      # detected is entered by hand.
+      probe_error = e
+      self.draw_probe_text("Hardware detection failed: %s\nThe parameters "
+                           "it didn't detect have to be entered by hand." % e)
+    try:
+      apply_hardware_probes(hardware_probes)
+    except Exception as e:
+      ERROR("Failed to apply the hardware detection: %s" % e)
+      self.draw_probe_text("Failed to apply the hardware detection: %s\n"
+                           "Press Next Page to exit the installer." % e)
+      self.probes_failed = True
+      return
+    if not needs_xc6320_banner():
+      if not probe_error:
+        self.proceedPage(None)
+      return
+    # Dell 2U4N (XC6320) systems must not skip the banner informing the user
+    # that it is absolutely critical to get node position and Block ID right.
+    self.draw_probe_text(
+      re.sub(r'\033\[[0-9;]*m|\x08', '', XC6320_BANNER).strip('\n'))
+
+  def proceed_after_probes(self, ignore):
+    if not hardware_probes.applied:
+      if self.probes_failed:
+        return self.handler.EXIT
+      return self.handler.HANDLED
+    return self.proceedPage(None)
 
   def init_header(self):
     y = 1
     x = 5
 
+    nos_version = image_catalog.get_nos_version()
     self.window.addnstr(y, x-2, "<< Nutanix Community Edition Installer - AOS %s >>" %
-                        get_packaged_nos()[0].version,
-                        48 + len(get_packaged_nos()[0].version))
+                        nos_version, 48 + len(nos_version))
     y += 2
 
     if gp.node_position_detected and gp.block_id_detected:
@@ -750,90 +2483,75 @@ class CEGui(object):
       return False
 
     disk = self.disk_select.get_selected_data()
-    if disk in self.iso_disks and c != ord('R'):
+    roles = self.disk_roles
+    role = roles.get(disk)
+    if role == DiskRoles.ISO and c != ord('R'):
       self.disk_select.temp_status = 'ISO installer disk(s) cannot be used as a destination.'
 
     elif c == ord('h'):
-      self.hyp_boot_disk = [disk]
-      if disk in self.cvm_boot_disk:
-        self.cvm_boot_disk.remove(disk)
-      if disk in self.cvm_data_disks:
-        self.cvm_data_disks.remove(disk)
+      for dev in roles.get_devices(DiskRoles.HYP_BOOT):
+        roles.clear(dev)
+      roles.set(disk, DiskRoles.HYP_BOOT)
 
     elif c == ord('c'):
       if not self.disks[disk].isSSD:
         self.disk_select.temp_status = 'CVM boot disk(s) must be SSDs.'
-      elif self.disks[disk].size < 200.0:
+      elif self.disks[disk].size < CE_MIN_DISK_GB:
         self.disk_select.temp_status = 'CVM boot disk(s) must be at least 200 GB in size.'
-      elif disk in self.cvm_boot_disk:
-        self.cvm_boot_disk.remove(disk)
+      elif role == DiskRoles.CVM_BOOT:
+        roles.clear(disk)
       else:
-        if len(self.cvm_boot_disk) in [0,1]:
-          self.cvm_boot_disk.append(disk)
-        else:
+        if roles.count(DiskRoles.CVM_BOOT) not in [0,1]:
           # could try to match disks by size
           # for now just replace one in rolling fashion
-          del self.cvm_boot_disk[0]
-          self.cvm_boot_disk.append(disk)
-        if disk in self.hyp_boot_disk:
-          self.hyp_boot_disk.remove(disk)
-        if disk in self.cvm_data_disks:
-          self.cvm_data_disks.remove(disk)
+          roles.clear_oldest(DiskRoles.CVM_BOOT)
+        roles.set(disk, DiskRoles.CVM_BOOT)
 
     elif c == ord('d'):
-      if self.disks[disk].size < 200.0:
+      if self.disks[disk].size < CE_MIN_DISK_GB:
         self.disk_select.temp_status = 'Data disk(s) must be at least 200 GB in size.'
-      elif disk in self.cvm_data_disks:
-        self.cvm_data_disks.remove(disk)
+      elif role == DiskRoles.CVM_DATA:
+        roles.clear(disk)
       else:
-        self.cvm_data_disks.append(disk)
-        if disk in self.hyp_boot_disk:
-          self.hyp_boot_disk.remove(disk)
-        if disk in self.cvm_boot_disk:
-          self.cvm_boot_disk.remove(disk)
+        roles.set(disk, DiskRoles.CVM_DATA)
 
     elif c == ord('R'):
-      disk_defaults = disk_info.choose_ce_disk_defaults(self.disks)
-      # don't have to worry about errors here as this was already done once
-      self.hyp_boot_disk = disk_defaults['HYP_BOOT']
-      self.cvm_boot_disk = disk_defaults['CVM_BOOT']
-      self.cvm_data_disks = disk_defaults['CVM_DATA']
+      disk_defaults, rationale = disk_placement.place(self.disks)
+      roles.load_defaults(disk_defaults, keep_iso=True)
+      self.disk_select.temp_status = rationale
 
     self.update_disk_usage()
 
-  def update_disk_usage(self):
-    for i in range(0, len(self.disk_select.keys)):
-      disk = self.disk_select.keys[i]
-      usage = ' '
-      if disk in self.iso_disks:
-        usage = 'I'
-      elif disk in self.hyp_boot_disk:
-        usage = 'H'
-      elif disk in self.cvm_boot_disk:
-        usage = 'C'
-      elif disk in self.cvm_data_disks:
-        usage = 'D'
-      self.disk_select.choices[i] = self.disk_select.choices[i][:-2] + usage + ']'
+  def decorate_disk_choice(self, idx, txt):
+    # Usage column of a visible disk row.
+    usage = self.disk_roles.get(self.disk_select.keys[idx]) or ' '
+    return txt[:-2] + usage + ']'
 
+  def update_disk_usage(self):
     if self.disk_select.temp_status:
       status = self.disk_select.temp_status
       self.disk_select.temp_status = None
-    elif not self.hyp_boot_disk:
-      status = "Installation cannot proceed without selecting a hypervisor boot disk."
-    elif not self.cvm_boot_disk:
-      status = "Installation cannot proceed without selecting one (or two) CVM boot disk(s)."
-    elif not self.cvm_data_disks:
-      status = "Installation cannot proceed without selecting one or more data disks."
     else:
-      status = "Hypervisor Boot: {}, CVM Boot: {}, Data: {}".format(
-                 self.hyp_boot_disk, self.cvm_boot_disk, self.cvm_data_disks)
+      status = self.disk_roles.get_status()
     _, width = self.window.getmaxyx()
     status += ' ' * (width - len(status) - self.disk_select.x)
+    status = status[:width - self.disk_select.x]
     self.window.addstr(self.disk_select.y + self.disk_select.height,
       self.disk_select.x, status)
 
   def init_page(self, y, x):
-    if self.page == 2:
+    if self.page == 0:
+      self.window.addstr(y, x, "Detecting hardware, please wait...")
+      y += 2
+      self.probes_y = y
+      self.probes_x = x
+      self.probes_failed = False
+      self.draw_hardware_probes()
+      y += len(PROBE_LABELS) + 1
+      self.probesButton = Button(self.window, y, x - 2, "Next Page",
+                                 self.proceed_after_probes)
+      self.handler.add(self.probesButton)
+    elif self.page == 2:
       self.init_header()
       self.eula = TextViewBlock(self.window, y, x, "ce_eula.txt", None, 'CE EULA', 60, 24, 1)
       self.handler.add(self.eula)
@@ -871,7 +2589,7 @@ class CEGui(object):
       # y += 2
       self.window.addstr(y, x, "Select Hypervisor:", 18)
       y += 1
-      ahv_ver = os.path.basename(get_packaged_hyp()[0].path)[:-4]
+      ahv_ver = os.path.basename(image_catalog.get_hyp()[0].path)[:-4]
       hyp_opts = ['AHV ({})'.format(ahv_ver), 'ESXi']
       self.hyp_select = RadioButton(self.window, y, x, hyp_opts)
       y += len(hyp_opts) - 1
@@ -885,7 +2603,7 @@ class CEGui(object):
       self.hyp_select.visible_on_opt('ESXi', [self.hyp_esx_path])
 
       # DISK SELECTION HERE
-      self.disks = disk_info.collect_disk_info(skip_part_info=False)
+      self.disks = disk_inventory.get()
       # DEBUG
       """
       import copy
@@ -905,17 +2623,9 @@ class CEGui(object):
       self.disks['nvme0n5'].dev = 'nvme0n5'
       """
       # END DEBUG
-      disk_defaults = disk_info.choose_ce_disk_defaults(self.disks)
-      if "error" in disk_defaults:
-        self.iso_disks = []
-        self.hyp_boot_disk = []
-        self.cvm_boot_disk = []
-        self.cvm_data_disks = []
-      else:
-        self.iso_disks = disk_defaults['PHOENIX_ISO']
-        self.hyp_boot_disk = disk_defaults['HYP_BOOT']
-        self.cvm_boot_disk = disk_defaults['CVM_BOOT']
-        self.cvm_data_disks = disk_defaults['CVM_DATA']
+      disk_defaults, rationale = disk_placement.place(self.disks)
+      self.disk_roles = DiskRoles()
+      self.disk_roles.load_defaults(disk_defaults)
       disk_selection_height = min(8, max(3, len(self.disks)+2))
 
       keys = []
@@ -962,7 +2672,8 @@ class CEGui(object):
       self.disk_select.set_cursor("==> ", " <==")
       self.disk_select.set_keystroke_handler(self.disk_custom_keys(),
                                              self.disk_custom_keystroke_handler)
-      self.disk_select.temp_status = None
+      self.disk_select.set_choice_decorator(self.decorate_disk_choice)
+      self.disk_select.temp_status = rationale
       self.update_disk_usage()
       self.handler.add(self.disk_select)
       y += disk_selection_height + 2
@@ -1008,7 +2719,7 @@ class CEGui(object):
       y += 1
 
       self.action = set([INSTALL_HYPERVISOR, INSTALL_SVM])
-      self.nos = get_packaged_nos()[0]
+      self.nos = image_catalog.get_nos()[0]
 
       self.position = FakeText('A')
       self.block_id =  FakeText(str(uuid4()).split('-')[0])
@@ -1069,6 +2780,8 @@ class Gui(object):
 
   # Validate user inputs and prints out an error if any
   def validate_input_params(self):
+    from shared_functions import validate_and_correct_network_addresses
+
     class DummyNode(object):
       def __init__(self, obj):
         self.cvm_ip = obj.svm_ip.get_displayed_text()
@@ -1135,6 +2848,8 @@ class Gui(object):
     return self.handler.HANDLED
 
   def init_review_ui(self):
+    from gui_review import get_review_content
+    from images import gui_message
     self.window.clear()
     self.window.border()
     self.window.keypad(1)
@@ -1280,6 +2995,9 @@ class Gui(object):
     self.handler.add(self.nextButton)
 
   def init_ui(self, stdscr):
+    from images import get_nos_from_cvm, gui_message
+    from layout.layout_finder import get_layout
+    from layout.layout_tools import get_possible_boot_devices_from_layout
     self.window.clear()
     self.window.keypad(1)
 
@@ -1472,7 +3190,7 @@ class Gui(object):
 
     y += 2
     self.window.addnstr(y, x - 5, "Version: %s" % PHOENIX_VERSION,40)
-    stdscr.refresh()
+    stdscr.noutrefresh()
 
   def interactive_ui(self, stdscr):
     self.stdscr = stdscr
@@ -1508,7 +3226,15 @@ class Gui(object):
       return self.handler.lastControl == self.confirmButton
 
 
-def get_node_positions():
+def get_system_manufacturer():
+  ret,out,err = shell.shell_cmd(["dmidecode -s system-manufacturer"])
+  mfg = ''
+  mfg_lines = out.strip().splitlines()
+  if mfg_lines:
+    mfg = mfg_lines[-1].lower()
+  return mfg
+
+def get_node_positions(mfg=None):
   model = gp.p_list.model_string
 
   if platform.machine() == ARCH_PPC:
@@ -1535,11 +3261,8 @@ def get_node_positions():
 
   # Hardcode node_position to "A" for Dell and Lenovo systems excluding
   # the 2U4N systems.
-  ret,out,err = shell.shell_cmd(["dmidecode -s system-manufacturer"])
-  mfg = ''
-  mfg_lines = out.strip().splitlines()
-  if mfg_lines:
-    mfg = mfg_lines[-1].lower()
+  if mfg is None:
+    mfg = get_system_manufacturer()
   if mfg.startswith("dell") or mfg.startswith("lenovo"):
     if gp.p_list.vpd_method in ["dell_2u4n", "lenovo_2u4n"]:
       np_choices = numerical_node_positions
@@ -1617,8 +3340,12 @@ def get_params_from_gui(obj):
     boot_disk = obj.boot_disk.get_selected_data()
     if boot_disk != "NR":
       boot_disk = boot_disk.replace("/dev/",'')
-      disks = disk_info.collect_disk_info(disk_list_filter=[boot_disk])
-      boot_disk_info = disks[boot_disk]
+      disks = disk_inventory.get(disk_list_filter=[boot_disk])
+      boot_disk_info = disks.get(boot_disk)
+      if not boot_disk_info:
+        raise ValidationError("Boot disk %s is no longer detected, its probe "
+                              "may have timed out. Check the disk and "
+                              "select the boot disk again." % boot_disk)
       gp.p_list.boot_disk_info = boot_disk_info
       gp.p_list.boot_disk = boot_disk_info.dev
       gp.p_list.boot_disk_model = boot_disk_info.model
@@ -1629,12 +3356,16 @@ def get_params_from_gui(obj):
     hypervisor = obj.hypervisor
     nos = obj.nos
     error = False
-    gp.p_list.ce_hyp_boot_disk = obj.hyp_boot_disk[0]
-    gp.p_list.ce_cvm_boot_disks = obj.cvm_boot_disk
-    gp.p_list.ce_cvm_data_disks = obj.cvm_data_disks
-    disks = disk_info.collect_disk_info()
+    gp.p_list.ce_hyp_boot_disk = obj.disk_roles.get_devices(DiskRoles.HYP_BOOT)[0]
+    gp.p_list.ce_cvm_boot_disks = obj.disk_roles.get_devices(DiskRoles.CVM_BOOT)
+    gp.p_list.ce_cvm_data_disks = obj.disk_roles.get_devices(DiskRoles.CVM_DATA)
+    disks = disk_inventory.get()
     for dev in gp.p_list.ce_cvm_boot_disks + gp.p_list.ce_cvm_data_disks:
-      disk = disks[dev]
+      disk = disks.get(dev)
+      if not disk:
+        raise ValidationError("Disk %s is no longer detected, its probe may "
+                              "have timed out. Check the disk and assign the "
+                              "disk roles again." % dev)
       # ESXi represents dash as 2D in disk list
       if disk.serial:
         serial = disk.serial
@@ -1643,53 +3374,53 @@ def get_params_from_gui(obj):
         gp.p_list.ce_wwns.append(disk.wwn)
 
     if hypervisor.hyp_type == "esx":
-      path = gp.p_list.esx_path.strip()
+      url = gp.p_list.esx_path.strip()
       ip = gp.p_list.host_ip
       subnet = gp.p_list.host_subnet_mask
       gw = gp.p_list.default_gw
-      if len(path) != 0 and len(ip) != 0 and len(subnet) != 0 and len(gw) != 0:
-        # calculate broadcast
-        ip_parts = ip.split(".")
-        sub_parts = subnet.split(".")
-        broadcast = ""
-        for ip_part, sub_part in zip(ip_parts, sub_parts):
-          if sub_part == "255":
-            broadcast += ip_part
-          if sub_part == "0":
-            broadcast += "255"
-          if (sub_part != "255" and sub_part != "0"):
-            multiplier = 256 - int(sub_part)
-            result = 0
-            while result <= int(ip_part):
-              result += multiplier
-            result = result - 1
-            broadcast += str(result)
-          broadcast += "."
-        broadcast = broadcast[:-1]
-        # create folder
-        shell.shell_cmd(['mkdir /esx_tmp'], fatal=False, ttyout=True)
-        shell.shell_cmd(['chmod 666 /esx_tmp'], fatal=False, ttyout=True)
-        # create network
-        print ("Configuring network...")
-        shell.shell_cmd(['ifconfig eth0 ' + ip + ' broadcast ' + broadcast + ' netmask ' + subnet + ' up'], fatal=False,
-                        ttyout=True)
-        shell.shell_cmd(['route add default gw ' + gw], fatal=False, ttyout=True)
-        # copy from path
-        time.sleep(5)
-        print("Copying ISO image...")
-        shell.shell_cmd(['cp /mnt/iso/images/hypervisor/esx/* /esx_tmp'], fatal=False, ttyout=True)
-        # add path to esx iso
-        ret, out, err = shell.shell_cmd(['ls /esx_tmp'])
-        lines = out.split('\n')
-        for line in lines:
-          if "iso" in line:
-            hypervisor.path = "/esx_tmp/" + line
-          else:
-            ERROR("ISO was not successfully downloaded, make sure URL: " + path +" you provided is accessible from: " + ip)
+      if len(url) != 0 and len(ip) != 0 and len(subnet) != 0 and len(gw) != 0:
+        iface = get_network_interface()
+        print("Configuring network on %s..." % iface)
+        try:
+          configure_interface(iface, ip, subnet, gw)
+          print("Network up after %.1f seconds" % wait_for_network(iface))
+        except ValueError as e:
+          ERROR("Invalid host network information: %s" % e)
+          error = True
+        except (IOError, OSError) as e:
+          ERROR("Failed to bring up the network on %s: %s" % (iface, e))
+          error = True
+        if not error:
+          name = os.path.basename(url.split('#')[0].split('?')[0])
+          dst = os.path.join(ESX_DOWNLOAD_DIR, name or 'esxi.iso')
+          download = ImageDownload(url, dst)
+          download.start()
+          try:
+            download.wait("Downloading ESXi ISO")
+            hypervisor.path = dst
+          except (IOError, OSError) as e:
+            ERROR("ISO was not successfully downloaded, make sure URL: " + url +
+                  " you provided is accessible from: " + ip + " (%s)" % e)
             error = True
-      else:
-        ERROR ("All host network information and URL to ESXi ISO must be given for ESXi hypervisor installation.")
+      elif len(url) != 0:
+        ERROR ("All host network information must be given to download the ESXi ISO.")
         error = True
+      else:
+        # Without a URL the ISO is installed from the boot media in place,
+        # only its ends are read here to tell it's readable.
+        image = image_catalog.find_hyp("esx")
+        if not image:
+          ERROR("No ESXi ISO found in %s, the URL to an ESXi ISO must be given" % IMAGES_DIR)
+          error = True
+        else:
+          try:
+            size = check_image_readable(image.path)
+            print("Installing ESXi from %s (%d MB) on the boot media" %
+                  (image.path, size // 1048576))
+            hypervisor.path = image.path
+          except (IOError, OSError) as e:
+            ERROR("ESXi ISO %s is not readable: %s" % (image.path, e))
+            error = True
     if error:
       raise ValidationError()
   else:
@@ -1751,9 +3482,18 @@ def get_params_from_gui(obj):
     # Copy it out of the CD image.
     if not os.path.exists(DRIVERS_DIR):
       os.mkdir(DRIVERS_DIR)
-    shutil.copy(driver_package, DRIVERS_DIR)
+    if not payload_prefetcher.claim(driver_package):
+      shutil.copy(driver_package, DRIVERS_DIR)
     gp.p_list.driver_package = os.path.join(DRIVERS_DIR, DRIVER_PACKAGE_NAME)
 
+  # Imaging reads the hypervisor and the AOS from the media from here on,
+  # the prefetch of them and of anything else left is given up so it doesn't
+  # compete for the media.
+  for path in (gp.p_list.hypervisor_iso_path, gp.p_list.installer_path):
+    if path:
+      payload_prefetcher.claim(path)
+  payload_prefetcher.stop()
+
   if gp.p_list.hyp_type == "esx":
     if not gp.p_list.hypervisor_iso_path:
       gp.p_list.hyp_version, gp.p_list.bootbank = \
@@ -1765,7 +3505,7 @@ def get_params(guitype, _one_node_cluster=False, _network_setup=False):
   """
   Run the GUI, and return param_list.
   """
-  global one_node_cluster, network_setup
+  global one_node_cluster, network_setup, hardware_probes
   one_node_cluster = _one_node_cluster
   network_setup = _network_setup
 
@@ -1778,27 +3518,39 @@ def get_params(guitype, _one_node_cluster=False, _network_setup=False):
     gp.p_list.factory_error_flag_file = "FIST.err"
     gp.p_list.factory_logfile_info = "phoenix_info.txt"
     gp.p_list.factory_logfile_error = "phoenix_error.txt"
+    from factory_workflow import fatal_exc_handler
     set_log_fatal_callback(fatal_exc_handler, (3,))
 
-  # Find existing nutanix partition and load existing factory config
-  # if it exists on that partition
-  gp.factory_config = sysUtil.find_factory_config()
-
-  # Auto-detect model and other parameters.
-  sysUtil.detect_params(gp.p_list, throw_on_fatal=False, skip_esx_info=True)
+  hardware_probes = HardwareProbes()
+  hardware_probes.start()
+  if getattr(guitype, 'shows_hardware_probes', False):
+    # The gui applies the results once the probes are done.
+    return run_gui(guitype)
 
+  hardware_probes.wait()
   # Display a banner if this is a Dell 2U4N (XC6320) system informing the user
   # that it is absolutely critical to get node position and Block ID correct.
-  if (gp.p_list.vpd_method == "dell_2u4n" and
-      gp.p_list.model_string.startswith("XC6320")):
+  if needs_xc6320_banner():
     answer = None
     while answer != 'Y':
       shell.shell_cmd(['clear'], fatal=False, ttyout=True)
       sys.stdout.write(XC6320_BANNER)
       answer = input("\nPlease enter 'Y' to proceed to the UI: ").upper()
+  apply_hardware_probes(hardware_probes)
+  return run_gui(guitype)
 
-  if not gp.factory_config:
-    gp.svm_data = sysUtil.find_svm_data()
+
+def needs_xc6320_banner():
+  return (gp.p_list.vpd_method == "dell_2u4n" and
+          gp.p_list.model_string.startswith("XC6320"))
+
+
+def apply_hardware_probes(probes):
+  """
+  Fills gp from the results of finished hardware probes.
+  """
+  gp.factory_config = probes.results.get('factory_config')
+  gp.svm_data = probes.results.get('svm_data', False)
 
   # Find detected elements and ensure they are indicated in the UI as
   # having been detected automatically from the hardware.
@@ -1817,7 +3569,8 @@ def get_params(guitype, _one_node_cluster=False, _network_setup=False):
     gp.node_positions = [('%s  ' % gp.p_list.node_position,
                                    gp.p_list.node_position)]
   else:
-    gp.node_positions = get_node_positions()
+    gp.node_positions = get_node_positions(
+      probes.results.get('system_manufacturer'))
     if len(gp.node_positions) == 1:
       gp.node_position_detected = True
     else:
@@ -1834,10 +3587,11 @@ def get_params(guitype, _one_node_cluster=False, _network_setup=False):
   gp.node_models = [(gp.p_list.model_string, gp.p_list.model_string)]
 
   gp.allowed_actions = determine_actions()
-  return run_gui(guitype)
+  probes.applied = True
 
 
 def run_gui(guitype):
+  start_payload_prefetch()
   gui = guitype()
   if type(gui) == type(CEGui()):
     global ce_gui
@@ -1867,3 +3621,8 @@ def run_gui(guitype):
       input("Press 'enter' to continue")
 
 __all__ = ["get_params"]
+
+if __name__ == "__main__" and sys.argv[1:2] == ["check-disk-qualifier"]:
+  # python gui.py check-disk-qualifier [dir] checks the disk qualification
+  # against sparse files and a loop device in dir, /tmp by default.
+  sys.exit(0 if check_disk_qualifier((sys.argv[2:] or ['/tmp'])[0]) else 1)
@@ -1,3 +1,18 @@
 cp /mnt/iso/gui.py /phoenix
+# Bytecode precompiled by generate_iso, used instead of compiling gui.py here.
+if ls /mnt/iso/__pycache__/gui.*.pyc >/dev/null 2>&1; then
+  mkdir -p /phoenix/__pycache__
+  cp /mnt/iso/__pycache__/gui.*.pyc /phoenix/__pycache__
+fi
 cd /phoenix
-COMMUNITY_EDITION=1 ./phoenix
\ No newline at end of file
+# QUALIFY_DISKS=1 /mnt/iso/install.sh adds a page testing the disks that fail
+# the CE minimum requirements, destroying the data at their start.
+# PROFILE_IMPORTS=1 /mnt/iso/install.sh reports where the installer spends
+# its startup time importing modules.
+if [ -n "$PROFILE_IMPORTS" ]; then
+  COMMUNITY_EDITION=1 PYTHONPROFILEIMPORTTIME=1 ./phoenix 2> /tmp/import_time.log
+  echo "Slowest imports, cumulative microseconds:"
+  grep '^import time: *[0-9]' /tmp/import_time.log | sort -t '|' -k 2 -n -r | head -n 25
+else
+  COMMUNITY_EDITION=1 ./phoenix
+fi
\ No newline at end of file